@@ -1,25 +1,40 @@
 
 from __future__ import annotations
 
+import asyncio
+import hashlib
 import json
+import multiprocessing
 import os
+import threading
 import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from typing import Optional
-from fastapi import APIRouter, Depends, FastAPI, HTTPException, Request, status
+from cachetools import TTLCache
+from fastapi import APIRouter, Depends, FastAPI, HTTPException, Query, Request, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from jose import JWTError, jwt
-from passlib.context import CryptContext
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, ConfigDict, EmailStr
 from fastapi.responses import JSONResponse
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+
+from password_utils import hash_password, pwd_context, verify_password
 
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "changeme-super-secret")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_SECONDS = 60 * 60 * 24  # 24 hours
+JWT_CACHE_TTL_SECONDS = 300  # upper bound on how long a validated token is trusted without re-checking
 
 USERS_FILE = Path(__file__).with_name("users.json")
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Argon2/bcrypt are CPU-bound and hold the GIL, so logins and registrations
+# hash in worker processes to use every core. The pool is created on first use
+# and dropped on shutdown, so each app lifespan gets a fresh one.
+_PWD_POOL: Optional[ProcessPoolExecutor] = None
+_PWD_POOL_LOCK = threading.Lock()
 
 auth_router = APIRouter()
 
@@ -33,6 +48,15 @@ class User(BaseModel):
     hashed_password: str
 
 
+class UserOut(BaseModel):
+    """Public view of a user; never carries the password hash."""
+
+    model_config = ConfigDict(from_attributes=True)
+
+    username: str
+    email: Optional[EmailStr] = None
+
+
 class UserCreate(BaseModel):
     username: str
     email: Optional[EmailStr] = None
@@ -49,6 +73,12 @@ class Token(BaseModel):
     token_type: str = "bearer"
 
 
+# Validated tokens keyed by SHA-256 of the raw JWT -> (user, exp). TTLCache is
+# not thread-safe and sync endpoints run in the threadpool, hence the lock.
+_JWT_CACHE: TTLCache[str, tuple[User, int]] = TTLCache(maxsize=10_000, ttl=JWT_CACHE_TTL_SECONDS)
+_JWT_CACHE_LOCK = threading.Lock()
+
+
 
 
 from db_backend_sqlalchemy import (
@@ -56,18 +86,12 @@ from db_backend_sqlalchemy import (
     get_user as _db_get_user,
     update_user as _db_update_user,
     delete_user as _db_delete_user,
-    SessionLocal as _SessionLocal,
+    get_db,
+    init_db as _init_db,
     UserModel as _UserModel,
 )
 
 
-def _load_users() -> dict[str, User]:
-    """Return all users from the DB as a dict keyed by username."""
-    with _SessionLocal() as db:
-        users = db.query(_UserModel).all()
-        return {u.username: User(username=u.username, email=u.email, hashed_password=u.hashed_password) for u in users}
-
-
 def _save_user(user: User):
     """Upsert a user inside the database (helper for register / update)."""
     existing = _db_get_user(user.username)
@@ -82,18 +106,33 @@ def _save_users(users: dict[str, User]):
         _save_user(user)
 
 
-def _delete_user(username: str):
-    _db_delete_user(username)
+def _delete_user(username: str, db: Optional[Session] = None):
+    _db_delete_user(username, db=db)
+
 
 
 
+def _get_pwd_pool() -> ProcessPoolExecutor:
+    global _PWD_POOL
+    with _PWD_POOL_LOCK:
+        if _PWD_POOL is None:
+            # Never fork: by now this process has threadpool threads running.
+            method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+            _PWD_POOL = ProcessPoolExecutor(
+                max_workers=int(os.getenv("PWD_POOL_WORKERS", os.cpu_count() or 1)),
+                mp_context=multiprocessing.get_context(method),
+            )
+        return _PWD_POOL
 
-def _verify_password(plain_password: str, hashed_password: str) -> bool:
-    return pwd_context.verify(plain_password, hashed_password)
 
+async def _run_in_pwd_pool(fn, *args):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_pwd_pool(), fn, *args)
 
-def _get_password_hash(password: str) -> str:
-    return pwd_context.hash(password)
+
+# Verified against when the username is unknown, so a miss costs the same
+# hashing work as a wrong password and does not reveal which names exist.
+_DUMMY_HASH = pwd_context.hash("dummy-password-for-timing-safety")
 
 
 def _create_access_token(data: dict, expires_delta: int = ACCESS_TOKEN_EXPIRE_SECONDS) -> str:
@@ -105,7 +144,45 @@ def _create_access_token(data: dict, expires_delta: int = ACCESS_TOKEN_EXPIRE_SE
 
 
 
-def _get_current_user(token: str = Depends(oauth2_scheme)) -> User:
+def _token_cache_key(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def _get_cached_user(token: str) -> User | None:
+    key = _token_cache_key(token)
+    with _JWT_CACHE_LOCK:
+        entry = _JWT_CACHE.get(key)
+        if entry is None:
+            return None
+        user, exp = entry
+        if exp <= time.time():
+            _JWT_CACHE.pop(key, None)
+            return None
+        return user
+
+
+def _cache_user(token: str, user: User, exp: int):
+    # TTLCache applies one TTL to every entry; the token's own `exp` is checked
+    # on read, so an entry never outlives the token it was derived from.
+    if exp <= time.time():
+        return
+    with _JWT_CACHE_LOCK:
+        _JWT_CACHE[_token_cache_key(token)] = (user, exp)
+
+
+def _invalidate_cached_user(username: str):
+    """Drop every cached token that resolves to `username`."""
+    with _JWT_CACHE_LOCK:
+        stale = [key for key, (user, _) in _JWT_CACHE.items() if user.username == username]
+        for key in stale:
+            _JWT_CACHE.pop(key, None)
+
+
+def _get_current_user(token: str = Depends(oauth2_scheme), db: Optional[Session] = Depends(get_db)) -> User:
+    cached = _get_cached_user(token)
+    if cached is not None:
+        return cached
+
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -119,23 +196,37 @@ def _get_current_user(token: str = Depends(oauth2_scheme)) -> User:
     except JWTError:
         raise credentials_exception
 
-    users = _load_users()
-    user = users.get(username)
-    if user is None:
+    row = _db_get_user(username, db=db)
+    if row is None:
         raise credentials_exception
+    user = User(username=row.username, email=row.email, hashed_password=row.hashed_password)
+    _cache_user(token, user, int(payload.get("exp", 0)))
     return user
 
 
+def _get_request_user(
+    request: Request,
+    token: str = Depends(oauth2_scheme),
+    db: Session = Depends(get_db),
+) -> User:
+    """Reuse the user `auth_middleware` already verified; decode `token` only if it did not run."""
+    user = getattr(request.state, "user", None)
+    if user is not None:
+        return user
+    return _get_current_user(token, db)
+
+
 
 
 @auth_router.post("/register", response_model=Token, status_code=201,operation_id="register")
-def register(user_in: UserCreate):
-    if _db_get_user(user_in.username):
+async def register(user_in: UserCreate, db: Session = Depends(get_db)):
+    hashed_pw = await _run_in_pwd_pool(hash_password, user_in.password)
+    # The unique username constraint does the duplicate check in the same INSERT.
+    try:
+        await run_in_threadpool(_db_create_user, user_in.username, hashed_pw, user_in.email, db=db)
+    except IntegrityError:
         raise HTTPException(status_code=400, detail="Username already registered")
 
-    hashed_pw = _get_password_hash(user_in.password)
-    _db_create_user(user_in.username, hashed_pw, user_in.email)
-
     token = _create_access_token({"sub": user_in.username})
     return Token(access_token=token)
 
@@ -146,40 +237,62 @@ class LoginInput(BaseModel):
 
 
 @auth_router.post("/login", response_model=Token, operation_id="login")
-def login(form_data: OAuth2PasswordRequestForm = Depends()):
-    
-
-    user_row = _db_get_user(form_data.username)
-    if user_row is None or not _verify_password(form_data.password, user_row.hashed_password):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    # DB calls go to the threadpool and hashing to the process pool, keeping
+    # the event loop free while either runs.
+    user_row = await run_in_threadpool(_db_get_user, form_data.username, db=db)
+    target_hash = user_row.hashed_password if user_row is not None else _DUMMY_HASH
+    password_ok = await _run_in_pwd_pool(verify_password, form_data.password, target_hash)
+    if user_row is None or not password_ok:
         raise HTTPException(status_code=401, detail="Incorrect username or password")
 
+    if pwd_context.needs_update(user_row.hashed_password):
+        new_hash = await _run_in_pwd_pool(hash_password, form_data.password)
+        await run_in_threadpool(_db_update_user, user_row.username, hashed_password=new_hash, db=db)
+        _invalidate_cached_user(user_row.username)
+
     token = _create_access_token({"sub": user_row.username})
     return Token(access_token=token)
 
 
-@auth_router.get("/users/me", response_model=User, operation_id="read_users_me")
+@auth_router.get("/users/me", response_model=UserOut, operation_id="read_users_me")
 def read_user_me(current_user: User = Depends(_get_current_user)):
     return current_user
 
 
-@auth_router.put("/users/me", response_model=User, operation_id="update_user_me")
-def update_user_me(update: UserUpdate, current_user: User = Depends(_get_current_user)):
+@auth_router.put("/users/me", response_model=UserOut, operation_id="update_user_me")
+def update_user_me(
+    update: UserUpdate,
+    current_user: User = Depends(_get_current_user),
+    db: Session = Depends(get_db),
+):
+    # current_user may come from a cache, so only write the fields the client sent;
+    # writing back its hashed_password could undo a password change made elsewhere.
+    new_hashed = hash_password(update.password) if update.password else None
+    _db_update_user(current_user.username, email=update.email, hashed_password=new_hashed, db=db)
+    _invalidate_cached_user(current_user.username)
     user_email = update.email if update.email is not None else current_user.email
-    new_hashed = _get_password_hash(update.password) if update.password else current_user.hashed_password
-    _db_update_user(current_user.username, email=user_email, hashed_password=new_hashed)
-    return User(username=current_user.username, email=user_email, hashed_password=new_hashed)
+    return UserOut(username=current_user.username, email=user_email)
 
 
 @auth_router.delete("/users/me", status_code=204, operation_id="delete_user_me")
-def delete_user_me(current_user: User = Depends(_get_current_user)):
-    _delete_user(current_user.username)
+def delete_user_me(current_user: User = Depends(_get_current_user), db: Session = Depends(get_db)):
+    _delete_user(current_user.username, db)
+    _invalidate_cached_user(current_user.username)
     return None
 
 
-@auth_router.get("/users", response_model=list[User], operation_id="read_users")
-def read_users(current_user: User = Depends(_get_current_user)):
-    """Retrieve details of all registered users (requires authentication)."""
-    return list(_load_users().values())
+@auth_router.get("/users", response_model=list[UserOut], operation_id="read_users")
+def read_users(
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=1000),
+    current_user: User = Depends(_get_current_user),
+    db: Session = Depends(get_db),
+):
+    """Retrieve one page of registered users, ordered by id (requires authentication)."""
+    rows = db.query(_UserModel).order_by(_UserModel.id).offset(skip).limit(limit).yield_per(500)
+    # Rows come straight from the DB, so skip re-validating every field.
+    return [UserOut.model_construct(username=u.username, email=u.email) for u in rows]
 
 
 
@@ -190,13 +303,20 @@ def _auth_middleware_factory(app: FastAPI):
     """Return middleware function that checks JWT for /query."""
 
     async def auth_middleware(request: Request, call_next):
-        if request.url.path.startswith("/query"):
+        # scope["path"] is a plain dict read; request.url would build a URL object.
+        if request.scope.get("path", "").startswith("/query"):
             auth_header: str | None = request.headers.get("Authorization")
-            if not auth_header or not auth_header.lower().startswith("bearer "):
+            # Only the 7-char scheme prefix is lowercased, however long the header is.
+            if not auth_header or auth_header[:7].lower() != "bearer ":
                 return _unauthorized()
-            token = auth_header.split()[1]
+            token = auth_header[7:].strip()
             try:
-                _get_current_user(token)  
+                # Cache hits are answered inline; a miss needs the DB, which must
+                # not block the event loop, so it goes to the threadpool.
+                user = _get_cached_user(token)
+                if user is None:
+                    user = await run_in_threadpool(_get_current_user, token, None)
+                request.state.user = user
             except HTTPException:
                 return _unauthorized()
         return await call_next(request)
@@ -214,6 +334,14 @@ def _unauthorized():
 
 
 
+def _shutdown_pwd_pool():
+    global _PWD_POOL
+    with _PWD_POOL_LOCK:
+        pool, _PWD_POOL = _PWD_POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
 def setup_auth(app: FastAPI):
     """Call once to attach router + middleware to an existing FastAPI `app`."""
 
@@ -223,6 +351,8 @@ def setup_auth(app: FastAPI):
 
     app.include_router(auth_router)
     app.middleware("http")(_auth_middleware_factory(app))
+    app.add_event_handler("startup", _init_db)
+    app.add_event_handler("shutdown", _shutdown_pwd_pool)
 
     app.state._auth_setup = True
 
@@ -232,5 +362,7 @@ try:
     from client import app as _existing_app
 
     setup_auth(_existing_app)
-except ModuleNotFoundError:
+except ImportError:
+    # Either client is unavailable, or it is importing us and has not defined
+    # `app` yet -- in which case client calls setup_auth itself.
     pass
@@ -1,4 +1,5 @@
 from fastapi import FastAPI, HTTPException, Depends
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 import json
 from typing import Dict, List, Optional
@@ -9,21 +10,75 @@ from contextlib import AsyncExitStack
 import os
 from dotenv import load_dotenv
 import re
+import traceback
 import uuid
-from fastapi.security import OAuth2PasswordBearer
+import weakref
+from cachetools import LRUCache
 
 from llms import AnthropicClient, OpenAIClient, GeminiClient
+from schema_utils import clean_openapi_schema
 
 load_dotenv()
 
-app = FastAPI()
+# Imported after load_dotenv so auth/DB settings from .env are picked up.
+from auth_setup import User, _get_request_user, setup_auth
 
-conversations: Dict[str, List[Dict]] = {}
+# orjson encodes responses in C; routers included below inherit this default.
+app = FastAPI(default_response_class=ORJSONResponse)
+setup_auth(app)
+
+# Least-recently-used conversations are dropped once CONV_MAX is reached.
+conversations: LRUCache[str, List[Dict]] = LRUCache(maxsize=int(os.getenv("CONV_MAX", "10000")))
+# One lock per conversation in flight; entries vanish once no request holds them.
+_conv_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+_PLACEHOLDER_RE = re.compile(r"^<(.+)>$")
+_DRIVE_URL_RE = re.compile(r"https://drive\.google\.com/\S+")
 
 class Query(BaseModel):
     text: str
     conversation_id: Optional[str] = None
 
+_NEWLINE = object()  # marker pushed between siblings in flatten_to_string
+
+
+def flatten_to_string(obj) -> str:
+    """Render nested message content as newline-separated text.
+
+    Lists and dicts are walked with an explicit stack and the leaves are
+    joined once at the end, so deep conversation histories neither recurse
+    nor build intermediate strings per level.
+    """
+    parts: List[str] = []
+    stack = [obj]
+    while stack:
+        node = stack.pop()
+        if node is _NEWLINE:
+            parts.append("\n")
+            continue
+        if isinstance(node, list):
+            if all(isinstance(x, dict) and x.get('type') == 'tool_result' for x in node):
+                children = [x.get('content', '') for x in node]
+            else:
+                children = node
+        elif isinstance(node, dict):
+            if "text" in node and len(node) == 1:
+                parts.append(str(node["text"]))
+                continue
+            if node.get('type') == 'tool_result' and 'content' in node:
+                stack.append(node['content'])
+                continue
+            children = list(node.values())
+        else:
+            parts.append(str(node))
+            continue
+        # Push in reverse so children pop in order, with separators between them.
+        for i in range(len(children) - 1, -1, -1):
+            stack.append(children[i])
+            if i:
+                stack.append(_NEWLINE)
+    return "".join(parts)
+
 class ServerConfig:
     def __init__(self, command: str, args: List[str], env: Optional[Dict[str, str]] = None):
         self.command = command
@@ -31,13 +86,12 @@ class ServerConfig:
         self.env = env
 
 def load_server_config_secrets(config):
-    placeholder_pattern = re.compile(r"^<(.+)>$")
     if isinstance(config, dict):
         return {k: load_server_config_secrets(v) for k, v in config.items()}
     elif isinstance(config, list):
         return [load_server_config_secrets(item) for item in config]
     elif isinstance(config, str):
-        match = placeholder_pattern.match(config)
+        match = _PLACEHOLDER_RE.match(config)
         if match:
             env_var = match.group(1)
             return os.getenv(env_var, f"<{env_var}_NOT_SET>")
@@ -68,9 +122,13 @@ class MCPClientManager:
         self.sessions: Dict[str, ClientSession] = {}
         self.exit_stack: Optional[AsyncExitStack] = None
         self.tools: List[Dict] = []
+        self.tools_by_name: Dict[str, Dict] = {}
 
     async def initialize_sessions(self):
         self.exit_stack = AsyncExitStack()
+        # Spawning the transports stays in this task: their anyio cancel scopes
+        # must be exited by the task that entered them (i.e. in shutdown).
+        pending: Dict[str, ClientSession] = {}
         for server_name, config in self.server_configs.items():
             server_params = StdioServerParameters(
                 command=config.command,
@@ -80,28 +138,41 @@ class MCPClientManager:
             try:
                 transport = await self.exit_stack.enter_async_context(stdio_client(server_params))
                 read_stream, write_stream = transport
-                session = await self.exit_stack.enter_async_context(ClientSession(read_stream, write_stream))
-                await session.initialize()
-                self.sessions[server_name] = session
-                print(f"Connected to {server_name} MCP server")
+                pending[server_name] = await self.exit_stack.enter_async_context(ClientSession(read_stream, write_stream))
             except Exception as e:
                 print(f"Failed to connect to {server_name}: {e}")
 
+        # The slow part is each server's handshake, so run those concurrently.
+        results = await asyncio.gather(
+            *(session.initialize() for session in pending.values()),
+            return_exceptions=True
+        )
+        for (server_name, session), result in zip(pending.items(), results):
+            if isinstance(result, BaseException):
+                print(f"Failed to connect to {server_name}: {result}")
+                continue
+            self.sessions[server_name] = session
+            print(f"Connected to {server_name} MCP server")
+
     async def load_tools(self):
-        for server_name, session in self.sessions.items():
-            try:
-                tools_result = await session.list_tools()
-                self.tools.extend([
-                    {
-                        "name": tool.name,
-                        "description": tool.description,
-                        "server": server_name,
-                        "input_schema": tool.inputSchema
-                    }
-                    for tool in tools_result.tools
-                ])
-            except Exception as e:
-                print(f"Error getting tools from {server_name}: {e}")
+        results = await asyncio.gather(
+            *(session.list_tools() for session in self.sessions.values()),
+            return_exceptions=True
+        )
+        for server_name, tools_result in zip(self.sessions, results):
+            if isinstance(tools_result, BaseException):
+                print(f"Error getting tools from {server_name}: {tools_result}")
+                continue
+            self.tools.extend([
+                {
+                    "name": tool.name,
+                    "description": tool.description,
+                    "server": server_name,
+                    "input_schema": tool.inputSchema
+                }
+                for tool in tools_result.tools
+            ])
+        self.tools_by_name = {tool["name"]: tool for tool in self.tools}
 
         print(f"Connected tools: {self.tools}")
 
@@ -125,113 +196,105 @@ mcp_client_manager = MCPClientManager(MCP_SERVERS)
 async def startup_event():
     await mcp_client_manager.initialize_sessions()
     await mcp_client_manager.load_tools()
+    # Tools are fixed once loaded, so build the Gemini declarations and client once.
+    app.state.function_declarations = [
+        {
+            "name": tool["name"],
+            "description": tool["description"],
+            "parameters": clean_openapi_schema(tool["input_schema"])
+        }
+        for tool in mcp_client_manager.tools
+        if all(k in tool for k in ("name", "description", "input_schema"))
+    ]
+    app.state.llm_client = GeminiClient(
+        api_key=os.getenv('GEMINI_API_KEY'),
+        function_declarations=app.state.function_declarations
+    )
 
 @app.on_event("shutdown")
 async def shutdown_event():
     await mcp_client_manager.shutdown()
 
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+def _conversation_lock(conv_id: str) -> asyncio.Lock:
+    lock = _conv_locks.get(conv_id)
+    if lock is None:
+        lock = _conv_locks[conv_id] = asyncio.Lock()
+    return lock
 
 @app.post("/query", operation_id="query")
-async def process_query(query: Query, token: str = Depends(oauth2_scheme)):
+async def process_query(query: Query, current_user: User = Depends(_get_request_user)):
     try:
-        conv_id = query.conversation_id or str(uuid.uuid4())
-        if conv_id not in conversations:
-            conversations[conv_id] = []
-        messages = conversations[conv_id]
-        messages.append({"role": "user", "content": query.text})
-
-        responses = []
-        MAX_STEPS = 4
-
-        for _ in range(MAX_STEPS):
-            from schema_utils import clean_openapi_schema
-            function_declarations = [
-                {
-                    "name": tool["name"],
-                    "description": tool["description"],
-                    "parameters": clean_openapi_schema(tool["input_schema"])
-                }
-                for tool in mcp_client_manager.tools
-                if all(k in tool for k in ("name", "description", "input_schema"))
-            ]
-
-            llm_client = GeminiClient(
-                api_key=os.getenv('GEMINI_API_KEY'),
-                function_declarations=function_declarations
-            )
-
-            def flatten_to_string(obj):
-                if isinstance(obj, list):
-                    if all(isinstance(x, dict) and x.get('type') == 'tool_result' for x in obj):
-                        return "\n".join(flatten_to_string(x.get('content', '')) for x in obj)
-                    return "\n".join(flatten_to_string(x) for x in obj)
-                elif isinstance(obj, dict):
-                    if "text" in obj and len(obj) == 1:
-                        return str(obj["text"])
-                    if obj.get('type') == 'tool_result' and 'content' in obj:
-                        return flatten_to_string(obj['content'])
-                    return "\n".join(flatten_to_string(v) for v in obj.values())
-                else:
-                    return str(obj)
-
-            gemini_messages = [
-                flatten_to_string(msg["content"]) if isinstance(msg, dict) and "content" in msg else flatten_to_string(msg)
-                for msg in messages
-            ]
-
-            response = await llm_client.create_message(gemini_messages)
-            parsed_response = llm_client.parse_response(response)
-
-            if parsed_response.content:
-                messages.append(flatten_to_string(parsed_response.content))
-
-            if parsed_response.text_content:
-                formatted_responses = []
-                for text in parsed_response.text_content:
-                    match = re.search(r"https://drive\.google\.com/\S+", text)
-                    if match:
-                        url = match.group()
-                        text = text.replace(url, f"[Click to view file]({url})")
-                    formatted_responses.append(text)
-                responses.extend(formatted_responses)
-
-            if not parsed_response.tool_calls:
-                break
-
-            for tool_call in parsed_response.tool_calls:
-                tool_name = tool_call.name
-                tool_args = tool_call.input
-
-                tool_info = next(tool for tool in mcp_client_manager.tools if tool["name"] == tool_name)
-                server_name = tool_info["server"]
-
-                tool_result = await mcp_client_manager.execute_tool(
-                    server_name=server_name,
-                    tool_name=tool_name,
-                    arguments=tool_args
-                )
-
-                responses.append(f"[Calling tool {tool_name} with args {tool_args}]")
-
-                if tool_name == "drive_share" and "fileId" in tool_args:
-                    file_id = tool_args["fileId"]
-                    link = f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
-                    responses.append(f"[Click to view file]({link})")
-                    messages.append({"role": "assistant", "content": link})
-
-                tool_result_msg = llm_client.parse_tool_result(tool_call=tool_call, tool_result=tool_result)
-                messages.append(tool_result_msg)
-
-        conversations[conv_id] = messages
-        return {
-            "conversation_id": conv_id,
-            "responses": responses,
-            "messages": messages
-        }
+        conv_id = query.conversation_id or uuid.uuid4().hex
+        # Serialise requests on the same conversation so their turns don't interleave.
+        async with _conversation_lock(conv_id):
+            if conv_id not in conversations:
+                conversations[conv_id] = []
+            messages = conversations[conv_id]
+            messages.append({"role": "user", "content": query.text})
+
+            responses = []
+            MAX_STEPS = 4
+            # Bind once so every step of this turn uses the same client and tool set,
+            # even if startup state is swapped while the turn is in flight.
+            llm_client = app.state.llm_client
+
+            for _ in range(MAX_STEPS):
+                gemini_messages = [
+                    flatten_to_string(msg["content"]) if isinstance(msg, dict) and "content" in msg else flatten_to_string(msg)
+                    for msg in messages
+                ]
+
+                response = await llm_client.create_message(gemini_messages)
+                parsed_response = llm_client.parse_response(response)
+
+                if parsed_response.content:
+                    messages.append(flatten_to_string(parsed_response.content))
+
+                if parsed_response.text_content:
+                    formatted_responses = []
+                    for text in parsed_response.text_content:
+                        match = _DRIVE_URL_RE.search(text)
+                        if match:
+                            url = match.group()
+                            text = text.replace(url, f"[Click to view file]({url})")
+                        formatted_responses.append(text)
+                    responses.extend(formatted_responses)
+
+                if not parsed_response.tool_calls:
+                    break
+
+                for tool_call in parsed_response.tool_calls:
+                    tool_name = tool_call.name
+                    tool_args = tool_call.input
+
+                    tool_info = mcp_client_manager.tools_by_name[tool_name]
+                    server_name = tool_info["server"]
+
+                    tool_result = await mcp_client_manager.execute_tool(
+                        server_name=server_name,
+                        tool_name=tool_name,
+                        arguments=tool_args
+                    )
+
+                    responses.append(f"[Calling tool {tool_name} with args {tool_args}]")
+
+                    if tool_name == "drive_share" and "fileId" in tool_args:
+                        file_id = tool_args["fileId"]
+                        link = f"https://drive.google.com/file/d/{file_id}/view?usp=sharing"
+                        responses.append(f"[Click to view file]({link})")
+                        messages.append({"role": "assistant", "content": link})
+
+                    tool_result_msg = llm_client.parse_tool_result(tool_call=tool_call, tool_result=tool_result)
+                    messages.append(tool_result_msg)
+
+            conversations[conv_id] = messages
+            return {
+                "conversation_id": conv_id,
+                "responses": responses,
+                "messages": messages
+            }
 
     except Exception as e:
-        import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -1,16 +1,27 @@
 """SQLAlchemy backend for user authentication storage.
 Creates a lightweight SQLite DB (default: users.db) with a `users` table.
+The engine is created on first use and tables by `init_db()` at app startup.
 """
 from __future__ import annotations
 
+import hashlib
+import hmac
+import math
 import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Iterator, Optional
 
-from sqlalchemy import Column, Integer, String, create_engine
-from sqlalchemy.exc import NoResultFound
+import anyio
+from cachetools import TTLCache
+from sqlalchemy import Column, Index, Integer, String, create_engine, delete, event, insert, select, text, update
+from sqlalchemy.engine import Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.orm import Session, make_transient_to_detached, sessionmaker
+from sqlalchemy.pool import StaticPool
 
 # ---------------------------------------------------------------------------
 # DATABASE INITIALISATION
@@ -22,85 +33,410 @@ POSTGRES_URL = os.getenv(
 )
 from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 
-url_parts = urlsplit(POSTGRES_URL)
-if url_parts.scheme.startswith("postgresql"):
+
+@lru_cache(maxsize=4)
+def _sanitize_url(url: str) -> str:
+    url_parts = urlsplit(url)
+    if not url_parts.scheme.startswith("postgresql"):
+        # For other schemes (e.g., sqlite for tests), keep the URL untouched.
+        return url
     # Sanitize the URL: remove unknown query params (e.g., 'supa') that psycopg2 rejects.
     qs = dict(parse_qsl(url_parts.query))
     allowed_params = {k: v for k, v in qs.items() if k in {"sslmode", "application_name"}}
     cleaned_query = urlencode(allowed_params)
-    DB_URL = urlunsplit((url_parts.scheme, url_parts.netloc, url_parts.path, cleaned_query, url_parts.fragment))
-else:
-    # For other schemes (e.g., sqlite for tests), keep the URL untouched.
-    DB_URL = POSTGRES_URL
+    return urlunsplit((url_parts.scheme, url_parts.netloc, url_parts.path, cleaned_query, url_parts.fragment))
+
+
+DB_URL = _sanitize_url(POSTGRES_URL)
+
+
+def _engine_kwargs(url: str) -> dict:
+    if url.startswith("sqlite"):
+        # SQLite uses SQLAlchemy's single-file pools, which take no sizing args.
+        kwargs = {"connect_args": {"check_same_thread": False}}
+        if make_url(url).database in (None, "", ":memory:"):
+            # Every connection to :memory: is a separate empty DB; share one so
+            # helpers running on worker threads see the same data.
+            kwargs["poolclass"] = StaticPool
+        return kwargs
+    kwargs = {
+        "pool_size": int(os.getenv("DB_POOL_SIZE", "10")),
+        "max_overflow": int(os.getenv("DB_MAX_OVERFLOW", "5")),
+        "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        # Fail fast with a clear error rather than queueing requests indefinitely.
+        "pool_timeout": int(os.getenv("DB_POOL_TIMEOUT", "10")),
+    }
+    if make_url(url).get_driver_name() == "psycopg2":
+        # Batch executemany UPDATE/DELETE too, not just INSERT.
+        kwargs["executemany_mode"] = "values_plus_batch"
+    return kwargs
+
+
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    # WAL lets readers proceed while a write is in progress.
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.close()
+
 
-# For PostgreSQL, no special SQLite connect_args are needed
-engine = create_engine(DB_URL, pool_pre_ping=True)
-SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+@lru_cache(maxsize=1)
+def get_engine() -> Engine:
+    """Create the engine on first use, so importing this module never connects."""
+    engine = create_engine(
+        DB_URL,
+        pool_pre_ping=True,
+        # Batch multi-row INSERT ... RETURNING into few statements (SQLAlchemy 2.x).
+        use_insertmanyvalues=True,
+        # Room for every compiled statement this module issues, so none is recompiled.
+        query_cache_size=1200,
+        **_engine_kwargs(DB_URL),
+    )
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _set_sqlite_pragmas)
+    return engine
+
+
+# Plain (not thread-scoped) factory: FastAPI may run a dependency's setup and
+# teardown on different threadpool workers, so get_db hands out explicit sessions.
+# Bound to the engine per session in _get_session, keeping engine creation lazy.
+SessionLocal = sessionmaker(autoflush=False, autocommit=False, expire_on_commit=False)
 
 Base = declarative_base()
 
 
 class UserModel(Base):
     __tablename__ = "users"
+    # Unique index on username that also carries the columns the auth lookups
+    # read, so Postgres can answer them with an index-only scan. create_all
+    # does not touch existing tables; migrate those by hand:
+    #   CREATE UNIQUE INDEX CONCURRENTLY ix_users_username_covering
+    #       ON users (username) INCLUDE (hashed_password, email);
+    #   DROP INDEX CONCURRENTLY ix_users_username;
+    __table_args__ = (
+        Index(
+            "ix_users_username_covering",
+            "username",
+            unique=True,
+            postgresql_include=["hashed_password", "email"],
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
-    username = Column(String, unique=True, nullable=False, index=True)
+    username = Column(String, nullable=False)
     email = Column(String, nullable=True)
     hashed_password = Column(String, nullable=False)
 
 
-# Create tables if they do not exist
-Base.metadata.create_all(bind=engine)
+def init_db():
+    """Create tables if they do not exist; run from the app's startup hook."""
+    Base.metadata.create_all(bind=get_engine())
 
 # ---------------------------------------------------------------------------
 # CRUD HELPERS
 # ---------------------------------------------------------------------------
 
+# get_user results by username, as detached copies so no session can mutate or
+# expire an object another request is reading. update/delete evict the entry.
+_user_cache: TTLCache[str, UserModel] = TTLCache(maxsize=10_000, ttl=int(os.getenv("USER_CACHE_TTL", "60")))
+_user_cache_lock = threading.Lock()
+
+
+def _cache_user(user: UserModel):
+    snapshot = UserModel(id=user.id, username=user.username, email=user.email, hashed_password=user.hashed_password)
+    # Detached with an identity key and clean state, so get_user can merge it
+    # into a caller's session without a query.
+    make_transient_to_detached(snapshot)
+    with _user_cache_lock:
+        _user_cache[user.username] = snapshot
+
+
+def _evict_user(username: str):
+    with _user_cache_lock:
+        _user_cache.pop(username, None)
+
+
+@event.listens_for(UserModel, "after_update")
+@event.listens_for(UserModel, "after_delete")
+def _evict_flushed_user(mapper, connection, target: UserModel):
+    # Callers may edit a get_user(db=...) result and commit it themselves.
+    _evict_user(target.username)
+
+
+class _BloomFilter:
+    """Fixed-size Bloom filter over strings: no false negatives, no deletes."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self._m = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        self._k = max(1, round(self._m / capacity * math.log(2)))
+        self._bits = bytearray((self._m + 7) // 8)
+
+    def _positions(self, item: str) -> Iterator[int]:
+        # Double hashing: k positions from the two halves of one digest.
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return ((h1 + i * h2) % self._m for i in range(self._k))
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+# Usernames that exist, so authenticate_user can reject unknown names (most
+# credential-stuffing traffic) without a DB query. Writes made through this
+# process are added as they happen, but a user created by any other process
+# (another uvicorn worker, a script) is missing until the next rebuild, and a
+# login for them would be rejected. So the filter assumes this process is the
+# only writer to `users`: set USERNAME_FILTER=0 when running several workers.
+# Rebuilds run in the background after enough deletes (which it cannot forget)
+# and every _BLOOM_MAX_AGE_SECONDS as a backstop for out-of-band writes.
+_BLOOM_ENABLED = os.getenv("USERNAME_FILTER", "1") == "1"
+_BLOOM_CAPACITY = 1_000_000
+_BLOOM_ERROR_RATE = 1e-4
+_BLOOM_REBUILD_AFTER_DELETES = 1000
+_BLOOM_MAX_AGE_SECONDS = 300
+_bloom: Optional[_BloomFilter] = None
+_bloom_built_at = 0.0
+_bloom_deletes = 0
+# While a rebuild scans the table, names added meanwhile are logged here and
+# replayed into the new filter; None when no rebuild is running.
+_bloom_pending: Optional[list[str]] = None
+# Bumped by _reset_caches so a rebuild started before a reset is discarded.
+_bloom_generation = 0
+_bloom_lock = threading.Lock()
+
+
+def _bloom_is_stale() -> bool:
+    return (
+        _bloom is None
+        or _bloom_deletes >= _BLOOM_REBUILD_AFTER_DELETES
+        or time.monotonic() - _bloom_built_at > _BLOOM_MAX_AGE_SECONDS
+    )
+
+
+def _scan_usernames() -> _BloomFilter:
+    bloom = _BloomFilter(_BLOOM_CAPACITY, _BLOOM_ERROR_RATE)
+    with get_engine().connect() as conn:
+        for username in conn.execute(select(UserModel.username)).scalars():
+            bloom.add(username)
+    return bloom
+
+
+def _rebuild_bloom():
+    """Scan the table into a new filter and swap it in, unless one is already running."""
+    global _bloom, _bloom_built_at, _bloom_deletes, _bloom_pending
+    with _bloom_lock:
+        if _bloom_pending is not None:
+            return
+        _bloom_pending = []
+        generation, deletes_before = _bloom_generation, _bloom_deletes
+    try:
+        bloom = _scan_usernames()
+    except BaseException:
+        with _bloom_lock:
+            if generation == _bloom_generation:
+                _bloom_pending = None
+        raise
+    with _bloom_lock:
+        if generation != _bloom_generation:
+            return
+        for username in _bloom_pending:
+            bloom.add(username)
+        # Deletes during the scan may or may not be reflected in it; keep them.
+        _bloom, _bloom_built_at = bloom, time.monotonic()
+        _bloom_deletes -= deletes_before
+        _bloom_pending = None
+
+
+def _start_bloom_rebuild():
+    threading.Thread(target=_rebuild_bloom, name="username-filter-rebuild", daemon=True).start()
+
+
+def _known_usernames() -> Optional[_BloomFilter]:
+    """Return the username filter, or None when it cannot answer yet.
+
+    A stale filter is rebuilt in the background and keeps serving until the
+    new one is swapped in. None (filter disabled, or not built yet) means
+    "unknown, ask the DB".
+    """
+    if not _BLOOM_ENABLED:
+        return None
+    with _bloom_lock:
+        needs_rebuild = _bloom_pending is None and _bloom_is_stale()
+    if needs_rebuild:
+        _start_bloom_rebuild()
+    return _bloom
+
+
+def _bloom_add(*usernames: str):
+    with _bloom_lock:
+        if _bloom is not None:
+            for username in usernames:
+                _bloom.add(username)
+        if _bloom_pending is not None:
+            _bloom_pending.extend(usernames)
+
+
+def _bloom_note_delete():
+    global _bloom_deletes
+    with _bloom_lock:
+        _bloom_deletes += 1
+
+
+def _reset_caches():
+    """Forget cached users and the username filter (e.g. after swapping DBs)."""
+    global _bloom, _bloom_deletes, _bloom_pending, _bloom_generation
+    with _user_cache_lock:
+        _user_cache.clear()
+    with _bloom_lock:
+        _bloom, _bloom_deletes, _bloom_pending = None, 0, None
+        _bloom_generation += 1
+
+
 def _get_session() -> Session:
-    return SessionLocal()
+    return SessionLocal(bind=get_engine())
+
+
+def get_db() -> Iterator[Session]:
+    """FastAPI dependency: one session shared by everything in a request."""
+    db = _get_session()
+    try:
+        yield db
+    finally:
+        db.close()
+
+
+@contextmanager
+def _session_scope(db: Optional[Session] = None) -> Iterator[Session]:
+    """Use the caller's session when given, otherwise open a short-lived one."""
+    if db is not None:
+        yield db
+        return
+    with _get_session() as own:
+        yield own
 
 
-def create_user(username: str, hashed_password: str, email: Optional[str] = None):
-    with _get_session() as db:
+def create_user(username: str, hashed_password: str, email: Optional[str] = None, *, db: Optional[Session] = None):
+    with _session_scope(db) as db:
         user = UserModel(username=username, hashed_password=hashed_password, email=email)
         db.add(user)
         db.commit()
-        db.refresh(user)
+        _bloom_add(username)
         return user
 
 
-def get_user(username: str) -> Optional[UserModel]:
-    with _get_session() as db:
-        try:
-            return db.query(UserModel).filter(UserModel.username == username).one()
-        except NoResultFound:
-            return None
+def create_users_bulk(rows: list[dict], *, db: Optional[Session] = None) -> list[int]:
+    """Insert many users with batched multi-row INSERTs and return their ids.
 
+    The ids are not guaranteed to be in row order: asking for that
+    (sort_by_parameter_order) makes SQLite fall back to one INSERT per row.
 
-def update_user(username: str, *, email: Optional[str] = None, hashed_password: Optional[str] = None):
-    with _get_session() as db:
-        user = db.query(UserModel).filter(UserModel.username == username).first()
-        if not user:
-            return None
-        if email is not None:
-            user.email = email
-        if hashed_password is not None:
-            user.hashed_password = hashed_password
+    Each row is a dict of UserModel columns (username, hashed_password, email);
+    `email` may be omitted. Rows are passed as executemany parameters rather
+    than baked into one statement with .values(), so insertmanyvalues pages
+    them. The ORM splits a batch wherever the set of non-NULL keys changes, so
+    missing `email` keys are filled in and render_nulls sends the NULLs as-is,
+    keeping every row the same shape and each page a single INSERT.
+    """
+    if not rows:
+        return []
+    params = [{"email": None, **row} for row in rows]
+    with _session_scope(db) as db:
+        stmt = insert(UserModel).returning(UserModel.id).execution_options(render_nulls=True)
+        ids = list(db.scalars(stmt, params))
         db.commit()
-        db.refresh(user)
+        _bloom_add(*(row["username"] for row in rows))
+        return ids
+
+
+# Hot path for every authenticated request: a fixed statement skips building and
+# compiling a select() on each call, while from_statement still loads UserModel
+# instances through the caller's identity map.
+_SELECT_USER = select(UserModel).from_statement(
+    text("SELECT id, username, email, hashed_password FROM users WHERE username = :u LIMIT 1").columns(
+        UserModel.id, UserModel.username, UserModel.email, UserModel.hashed_password
+    )
+)
+
+
+def get_user(username: str, *, db: Optional[Session] = None) -> Optional[UserModel]:
+    """Look up `username`, serving repeat lookups from a short-lived cache.
+
+    With `db`, the result is always bound to that session: a cache hit is
+    merged into its identity map (no query), so edits followed by
+    `db.commit()` are saved. Without `db`, a hit is the shared detached copy
+    and must be treated as read-only.
+    """
+    with _user_cache_lock:
+        cached = _user_cache.get(username)
+    if cached is not None:
+        return db.merge(cached, load=False) if db is not None else cached
+    with _session_scope(db) as db:
+        user = db.execute(_SELECT_USER, {"u": username}).scalar_one_or_none()
+    if user is not None:
+        _cache_user(user)
+    return user
+
+
+def update_user(
+    username: str,
+    *,
+    email: Optional[str] = None,
+    hashed_password: Optional[str] = None,
+    db: Optional[Session] = None,
+):
+    values = {k: v for k, v in {"email": email, "hashed_password": hashed_password}.items() if v is not None}
+    if not values:
+        return get_user(username, db=db)
+    # One UPDATE ... RETURNING instead of SELECT-then-UPDATE.
+    with _session_scope(db) as db:
+        user = db.execute(
+            update(UserModel).where(UserModel.username == username).values(values).returning(UserModel)
+        ).scalar_one_or_none()
+        db.commit()
+        _evict_user(username)
         return user
 
 
-def delete_user(username: str):
-    with _get_session() as db:
-        user = db.query(UserModel).filter(UserModel.username == username).first()
-        if user:
-            db.delete(user)
-            db.commit()
+def delete_user(username: str, *, db: Optional[Session] = None):
+    with _session_scope(db) as db:
+        result = db.execute(delete(UserModel).where(UserModel.username == username))
+        db.commit()
+        _evict_user(username)
+        if result.rowcount:
+            _bloom_note_delete()
+
+
+_SELECT_HASH = text("SELECT hashed_password FROM users WHERE username = :u LIMIT 1")
+
+
+def _get_stored_hash(username: str) -> Optional[str]:
+    known = _known_usernames()
+    if known is not None and username not in known:
+        return None
+    # Only the hash is needed, so skip the Session and ORM object entirely.
+    with get_engine().connect() as conn:
+        return conn.execute(_SELECT_HASH, {"u": username}).scalar()
+
 
+async def authenticate_user(
+    username: str,
+    secret: str,
+    verify: Optional[Callable[[str, str], bool]] = None,
+) -> bool:
+    """Check `secret` against the stored hash without blocking the event loop.
 
-def authenticate_user(username: str, hashed_password: str) -> bool:
-    user = get_user(username)
-    if not user:
+    By default `secret` is a hash compared in constant time. Pass a KDF check
+    such as `password_utils.verify_password` to verify a plaintext password
+    instead. The DB lookup and `verify` both run in worker threads.
+    """
+    stored = await anyio.to_thread.run_sync(_get_stored_hash, username)
+    if stored is None:
         return False
-    return user.hashed_password == hashed_password
+    if verify is not None:
+        return await anyio.to_thread.run_sync(verify, secret, stored)
+    return hmac.compare_digest(stored.encode(), secret.encode())
@@ -15,20 +15,35 @@ from fastapi_mcp import FastApiMCP, AuthConfig
 import auth_setup as auth
 
 
-# Initialize MCP
-mcp = FastApiMCP(
-    app,
-    include_operations=[
-        "query", "register", "login",
-        "read_users_me", "update_user_me",
-        "delete_user_me", "read_users", "read_user",
-    ],
-    auth_config=AuthConfig(
-        dependencies=[Depends(auth._get_current_user)],
-    ),
+MCP_OPERATIONS = (
+    "query", "register", "login",
+    "read_users_me", "update_user_me",
+    "delete_user_me", "read_users", "read_user",
 )
 
-mcp.mount()
+
+def _build_mcp() -> FastApiMCP:
+    """Scan the app's routes into MCP tools and mount them, once per app."""
+    # Kept on app.state (like setup_auth's flag) rather than in an lru_cache, so
+    # a second copy of this module (`__main__` vs `main`) reuses it too.
+    existing = getattr(app.state, "mcp", None)
+    if existing is not None:
+        return existing
+
+    mcp = FastApiMCP(
+        app,
+        include_operations=list(MCP_OPERATIONS),
+        auth_config=AuthConfig(
+            dependencies=[Depends(auth._get_current_user)],
+        ),
+    )
+    mcp.mount()
+    app.state.mcp = mcp
+    return mcp
+
+
+# Initialize MCP
+mcp = _build_mcp()
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", 8000)))
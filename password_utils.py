@@ -0,0 +1,28 @@
+"""Password hashing shared by the auth routes.
+
+Kept free of app imports so the password worker processes started by
+`auth_setup` only need passlib to run these functions.
+"""
+import os
+
+from passlib.context import CryptContext
+
+# New hashes use Argon2id; legacy bcrypt hashes still verify and are upgraded
+# on the next successful login (see `auth_setup.login`).
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    default="argon2",
+    deprecated="auto",
+    bcrypt__rounds=int(os.getenv("BCRYPT_ROUNDS", "12")),
+    argon2__time_cost=2,
+    argon2__memory_cost=19456,
+    argon2__parallelism=1,
+)
+
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    return pwd_context.verify(plain_password, hashed_password)
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
@@ -4,8 +4,13 @@ setup(
     name="fast-mcp-client",
     version="0.1",
     packages=find_packages(),
+    python_requires=">=3.10",
     install_requires=[
-        "SQLAlchemy>=1.4",
+        "SQLAlchemy>=2.0",
+        "cachetools>=5.0",
+        "anyio>=3.0",
+        "orjson>=3.9",
         "psycopg2-binary>=2.9",
+        "pydantic>=2.6",
     ],
 )
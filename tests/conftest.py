@@ -1,30 +1,56 @@
 import os
-import importlib
+import pathlib
 import sys
 
 import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
 
+sys.path.append(str(pathlib.Path(__file__).parent.parent))
+
+# Set before the import so DB_URL can never point at the real database, even
+# in a test that runs a helper or an app lifespan without the auth_db fixture.
+os.environ["POSTGRES_URL"] = "sqlite:///:memory:"
+
+import db_backend_sqlalchemy as db_backend
 
-@pytest.fixture(scope="function")
-def auth_db():
-    """Provide the db_backend_sqlalchemy module wired to an in-memory SQLite DB.
 
-    We set POSTGRES_URL to an in-memory SQLite URL **before** importing the module
-    so that its global engine points to the lightweight test DB. This keeps the
-    unit-tests fast and self-contained while exercising the same ORM code.
+@pytest.fixture(scope="session")
+def _mem_engine():
+    """One in-memory SQLite engine, with the schema created, for the whole run.
+
+    StaticPool hands every checkout the same connection, so sessions and the
+    helpers' worker threads all see the same in-memory database.
     """
-    os.environ["POSTGRES_URL"] = "sqlite:///:memory:"
+    engine = create_engine(
+        "sqlite:///:memory:",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    db_backend.Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
 
-    if "db_backend_sqlalchemy" in sys.modules:
-        del sys.modules["db_backend_sqlalchemy"]
 
-    import pathlib
-    
-    sys.path.append(str(pathlib.Path(__file__).parent.parent))
-    import db_backend_sqlalchemy as db_backend
+@pytest.fixture(scope="function")
+def auth_db(_mem_engine, monkeypatch):
+    """Provide the db_backend_sqlalchemy module wired to the in-memory SQLite DB.
 
-    db_backend.Base.metadata.create_all(bind=db_backend.engine)
+    The module is imported once; each test swaps its engine for the shared
+    in-memory one instead of re-importing it, and the tables are emptied
+    afterwards rather than dropped and re-created. This keeps the unit-tests
+    fast and self-contained while exercising the same ORM code.
+    """
+    monkeypatch.setattr(db_backend, "get_engine", lambda: _mem_engine)
+    # Rebuild the username filter inline: a background scan would share the
+    # single StaticPool connection with the test's own queries.
+    monkeypatch.setattr(db_backend, "_start_bloom_rebuild", db_backend._rebuild_bloom)
+    db_backend._reset_caches()
 
     yield db_backend
 
-    db_backend.Base.metadata.drop_all(bind=db_backend.engine)
+    # The helpers commit in their own sessions, so an outer SAVEPOINT cannot
+    # roll them back; emptying the tables is the cheap reset instead.
+    with _mem_engine.begin() as conn:
+        for table in reversed(db_backend.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
@@ -1,3 +1,5 @@
+import asyncio
+
 import pytest
 
 
@@ -24,11 +26,147 @@ def test_update_user(auth_db):
 
 def test_authenticate_user(auth_db):
     auth_db.create_user(USERNAME, PASSWORD, EMAIL)
-    assert auth_db.authenticate_user(USERNAME, PASSWORD) is True
-    assert auth_db.authenticate_user(USERNAME, "wrong") is False
+    assert asyncio.run(auth_db.authenticate_user(USERNAME, PASSWORD)) is True
+    assert asyncio.run(auth_db.authenticate_user(USERNAME, "wrong")) is False
+
+
+def test_authenticate_user_with_verify(auth_db):
+    auth_db.create_user(USERNAME, PASSWORD, EMAIL)
+
+    def verify(secret, stored):
+        return secret.upper() == stored.upper()
+
+    assert asyncio.run(auth_db.authenticate_user(USERNAME, "HASHED_PW", verify)) is True
+    assert asyncio.run(auth_db.authenticate_user("nobody", "HASHED_PW", verify)) is False
 
 
 def test_delete_user(auth_db):
     auth_db.create_user(USERNAME, PASSWORD, EMAIL)
     auth_db.delete_user(USERNAME)
     assert auth_db.get_user(USERNAME) is None
+
+
+def test_helpers_reuse_caller_session(auth_db):
+    db_gen = auth_db.get_db()
+    db = next(db_gen)
+    created = auth_db.create_user(USERNAME, PASSWORD, EMAIL, db=db)
+    # Same identity map: the lookup returns the instance created above.
+    assert auth_db.get_user(USERNAME, db=db) is created
+    auth_db.update_user(USERNAME, email="alice@newmail.com", db=db)
+    db_gen.close()
+    assert auth_db.get_user(USERNAME).email == "alice@newmail.com"
+
+
+def test_cached_get_user_is_bound_to_caller_session(auth_db):
+    auth_db.create_user(USERNAME, PASSWORD, EMAIL)
+    auth_db.get_user(USERNAME)  # warm the cache
+    db_gen = auth_db.get_db()
+    db = next(db_gen)
+    user = auth_db.get_user(USERNAME, db=db)
+    assert user in db
+    assert auth_db.get_user(USERNAME, db=db) is user
+    user.email = "alice@newmail.com"
+    db.commit()
+    db_gen.close()
+    assert auth_db.get_user(USERNAME).email == "alice@newmail.com"
+
+
+def test_create_duplicate_user_raises(auth_db):
+    from sqlalchemy.exc import IntegrityError
+
+    auth_db.create_user(USERNAME, PASSWORD, EMAIL)
+    with pytest.raises(IntegrityError):
+        auth_db.create_user(USERNAME, "other_pw")
+
+
+def test_get_user_cache_is_evicted_on_write(auth_db):
+    auth_db.create_user(USERNAME, PASSWORD, EMAIL)
+    auth_db.get_user(USERNAME)
+    # Served from the cache: the same detached copy each time.
+    assert auth_db.get_user(USERNAME) is auth_db.get_user(USERNAME)
+    auth_db.update_user(USERNAME, email="alice@newmail.com")
+    assert auth_db.get_user(USERNAME).email == "alice@newmail.com"
+    auth_db.delete_user(USERNAME)
+    assert auth_db.get_user(USERNAME) is None
+
+
+def test_create_users_bulk(auth_db):
+    rows = [
+        {"username": "bob", "hashed_password": "pw1", "email": "bob@example.com"},
+        {"username": "carol", "hashed_password": "pw2", "email": None},
+    ]
+    ids = auth_db.create_users_bulk(rows)
+    assert len(set(ids)) == 2
+    assert auth_db.get_user("carol").hashed_password == "pw2"
+    assert auth_db.create_users_bulk([]) == []
+
+
+def test_create_users_bulk_with_mixed_keys(auth_db):
+    rows = [
+        {"username": "bob", "hashed_password": "pw1", "email": "bob@example.com"},
+        {"username": "carol", "hashed_password": "pw2"},
+        {"username": "dave", "hashed_password": "pw3", "email": "dave@example.com"},
+    ]
+    ids = auth_db.create_users_bulk(rows)
+    assert sorted(auth_db.get_user(row["username"]).id for row in rows) == sorted(ids)
+    assert auth_db.get_user("carol").email is None
+    assert auth_db.get_user("dave").email == "dave@example.com"
+
+
+def test_written_user_is_readable_after_session_closes(auth_db):
+    user = auth_db.create_user(USERNAME, PASSWORD, EMAIL)
+    assert user.id is not None and user.email == EMAIL
+    updated = auth_db.update_user(USERNAME, email="alice@newmail.com")
+    assert updated.email == "alice@newmail.com"
+
+
+def test_sanitize_url_drops_unknown_postgres_params(auth_db):
+    url = "postgresql+psycopg2://u:p@host:6543/db?sslmode=require&supa=base-pooler.x"
+    assert auth_db._sanitize_url(url) == "postgresql+psycopg2://u:p@host:6543/db?sslmode=require"
+    assert auth_db._sanitize_url("sqlite:///:memory:") == "sqlite:///:memory:"
+
+
+def test_authenticate_user_sees_users_created_after_filter_build(auth_db):
+    assert asyncio.run(auth_db.authenticate_user(USERNAME, PASSWORD)) is False
+    auth_db.create_user(USERNAME, PASSWORD, EMAIL)
+    auth_db.create_users_bulk([{"username": "bob", "hashed_password": "pw1"}])
+    assert asyncio.run(auth_db.authenticate_user(USERNAME, PASSWORD)) is True
+    assert asyncio.run(auth_db.authenticate_user("bob", "pw1")) is True
+
+
+def test_update_and_delete_missing_user_are_noops(auth_db):
+    assert auth_db.update_user("nobody", email="nobody@example.com") is None
+    auth_db.delete_user("nobody")
+    assert auth_db.get_user("nobody") is None
+
+
+def test_users_created_during_filter_rebuild_are_kept(auth_db, monkeypatch):
+    scan = auth_db._scan_usernames
+
+    def scan_then_register():
+        bloom = scan()
+        # Runs while the rebuild is in flight; would deadlock if it held the lock.
+        auth_db.create_user(USERNAME, PASSWORD, EMAIL)
+        return bloom
+
+    monkeypatch.setattr(auth_db, "_scan_usernames", scan_then_register)
+    auth_db._rebuild_bloom()
+    assert USERNAME in auth_db._known_usernames()
+
+
+def test_stale_filter_keeps_serving_while_rebuilt_in_background(auth_db, monkeypatch):
+    auth_db._rebuild_bloom()
+    current = auth_db._known_usernames()
+    started = []
+    monkeypatch.setattr(auth_db, "_start_bloom_rebuild", lambda: started.append(True))
+    monkeypatch.setattr(auth_db, "_bloom_built_at", float("-inf"))
+
+    assert auth_db._known_usernames() is current
+    assert started == [True]
+
+
+def test_disabled_filter_defers_to_db(auth_db, monkeypatch):
+    monkeypatch.setattr(auth_db, "_BLOOM_ENABLED", False)
+    assert auth_db._known_usernames() is None
+    auth_db.create_user(USERNAME, PASSWORD, EMAIL)
+    assert asyncio.run(auth_db.authenticate_user(USERNAME, PASSWORD)) is True
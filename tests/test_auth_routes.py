@@ -0,0 +1,81 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+
+USERNAME = "alice"
+PASSWORD = "s3cret-pw"
+EMAIL = "alice@example.com"
+
+
+@pytest.fixture
+def auth(auth_db):
+    import auth_setup
+
+    with auth_setup._JWT_CACHE_LOCK:
+        auth_setup._JWT_CACHE.clear()
+    yield auth_setup
+    with auth_setup._JWT_CACHE_LOCK:
+        auth_setup._JWT_CACHE.clear()
+
+
+@pytest.fixture
+def client(auth):
+    app = FastAPI()
+    auth.setup_auth(app)
+    return TestClient(app)
+
+
+def _register(client, username=USERNAME, password=PASSWORD, email=EMAIL):
+    resp = client.post("/register", json={"username": username, "password": password, "email": email})
+    assert resp.status_code == 201
+    return {"Authorization": f"Bearer {resp.json()['access_token']}"}
+
+
+def _login(client, username=USERNAME, password=PASSWORD):
+    return client.post("/login", data={"username": username, "password": password})
+
+
+def test_email_only_update_keeps_password_changed_elsewhere(client, auth, auth_db):
+    headers = _register(client)
+    # Cache the token's user, hash included, as a request on this worker would.
+    assert client.get("/users/me", headers=headers).status_code == 200
+
+    # Another worker changes the password; this worker's token cache is not told.
+    auth_db.update_user(USERNAME, hashed_password=auth.hash_password("new-pw"))
+
+    resp = client.put("/users/me", json={"email": "alice@newmail.com"}, headers=headers)
+    assert resp.status_code == 200
+    assert resp.json() == {"username": USERNAME, "email": "alice@newmail.com"}
+    assert _login(client, password="new-pw").status_code == 200
+    assert _login(client).status_code == 401
+
+
+def test_put_users_me_invalidates_cached_token_user(client):
+    headers = _register(client)
+    assert client.get("/users/me", headers=headers).json()["email"] == EMAIL
+
+    client.put("/users/me", json={"email": "alice@newmail.com"}, headers=headers)
+
+    assert client.get("/users/me", headers=headers).json()["email"] == "alice@newmail.com"
+
+
+def test_delete_users_me_invalidates_cached_token_user(client):
+    headers = _register(client)
+    assert client.get("/users/me", headers=headers).status_code == 200
+
+    assert client.delete("/users/me", headers=headers).status_code == 204
+
+    assert client.get("/users/me", headers=headers).status_code == 401
+
+
+def test_password_pool_survives_app_restart(auth):
+    app = FastAPI()
+    auth.setup_auth(app)
+    for _ in range(2):
+        # Each `with` runs startup and shutdown, as a worker restart would.
+        with TestClient(app) as client:
+            headers = _register(client)
+            assert _login(client).status_code == 200
+            assert client.delete("/users/me", headers=headers).status_code == 204
+        assert auth._PWD_POOL is None
@@ -1,4 +1,4 @@
-import requests
+import httpx
 import json
 import webbrowser
 from http.server import HTTPServer, BaseHTTPRequestHandler
@@ -12,6 +12,10 @@ TOKEN_URL = "https://oauth2.googleapis.com/token"
 AUTH_URL = "https://accounts.google.com/o/oauth2/v2/auth"
 SCOPE = "openid email profile https://www.googleapis.com/auth/drive"
 
+# Reused for the token exchange so a retry keeps the same connection.
+_HTTP = httpx.Client(timeout=10)
+token_received = False
+
 # === Step 1: Open browser for login ===
 auth_url = (
     f"{AUTH_URL}"
@@ -50,7 +54,7 @@ def exchange_code_for_token(code):
         "grant_type": "authorization_code"
     }
 
-    res = requests.post(TOKEN_URL, data=data)
+    res = _HTTP.post(TOKEN_URL, data=data)
     tokens = res.json()
     print("✅ Token response:")
     print(json.dumps(tokens, indent=4))
@@ -59,11 +63,13 @@ def exchange_code_for_token(code):
         json.dump(tokens, f, indent=4)
         print("💾 Saved token to token.json")
 
-    # Exit server after token is received
-    import sys
-    sys.exit()
+    global token_received
+    token_received = True
 
-# Run temporary HTTP server to receive the code
+# Serve one request at a time until the redirect carrying the code arrives
+# (the browser may ask for other paths, e.g. /favicon.ico, first).
 print("🌐 Waiting for Google to redirect to http://localhost:4100/code ...")
-server = HTTPServer(('localhost', 4100), OAuthHandler)
-server.serve_forever()
+with HTTPServer(('localhost', 4100), OAuthHandler) as server:
+    while not token_received:
+        server.handle_request()
+_HTTP.close()
@@ -1,22 +1,18 @@
 import requests
-import json
+from requests.adapters import HTTPAdapter
+
+# One keep-alive session so repeated requests reuse the TCP connection.
+_SESSION = requests.Session()
+_SESSION.mount("http://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
 
 conv_id=None
 def send_request(query,conv_id=None):
     url = "http://localhost:8000/query"
 
-    headers = {
-        "Content-Type": "application/json",
-    }
-    payload = json.dumps({
-        "text": query
-    })
+    payload = {"text": query}
     if conv_id:
-        payload=json.dumps({
-            "text": query,
-            "conversation_id": conv_id
-        })
-    response = requests.post(url, headers=headers, data=payload)
+        payload["conversation_id"] = conv_id
+    response = _SESSION.post(url, json=payload)
     conv_id=response.json().get("conversation_id")
     return response.text
 
@@ -1,7 +1,10 @@
 from typing import Dict, List, Optional
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 
 class GDriveSearchParams(BaseModel):
+    # Built once per call and never mutated: frozen, and unknown fields rejected.
+    model_config = ConfigDict(frozen=True, extra="forbid", validate_assignment=False)
+
     query: str
     page_size: Optional[int] = 10
     page_token: Optional[str] = None